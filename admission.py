@@ -0,0 +1,114 @@
+import threading
+
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic
+from flask import jsonify
+
+
+class Gate:
+    """
+    A class used to limit the number of concurrent requests to an endpoint.
+    Requests over the limit wait in a bounded queue, the ones which
+    don't fit into the queue or wait for too long are shed.
+    """
+
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            if self.in_flight >= self.limit:
+                if self.queued >= self.queue_size:
+                    self.shed += 1
+                    return False
+                self.queued += 1
+                deadline = monotonic() + self.timeout
+                while self.in_flight >= self.limit:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self.queued -= 1
+                        self.shed += 1
+                        return False
+                    self.condition.wait(remaining)
+                self.queued -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def metrics(self):
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "queue_size": self.queue_size,
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "shed": self.shed
+            }
+
+
+class AdmissionController:
+    """
+    A class used to keep the gates of the endpoints
+    which have to be protected from overload.
+    Endpoints which compete for the same resource share a gate.
+    """
+
+    def __init__(self, retry_after=1):
+        self.retry_after = retry_after
+        self.gates = {}
+
+    def add_gate(self, name, concurrency, queue_size, timeout=5):
+        self.gates[name] = Gate(concurrency, queue_size, timeout)
+
+    @contextmanager
+    def admit(self, name):
+        """
+        Holds the named gate for the block if it admits the request.
+        Yields:
+            True if the request was admitted, False if it has to be shed
+        """
+        gate = self.gates[name]
+        if not gate.acquire():
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            gate.release()
+
+    def overloaded(self):
+        response = {"error": "Service overloaded"}
+        headers = {"Retry-After": str(self.retry_after)}
+        return jsonify(response), 503, headers
+
+    def limit(self, name):
+        """
+        Decorates a view, so it is run only when the named gate admits it
+        and answers 503 with Retry-After when the gate is overloaded.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                with self.admit(name) as admitted:
+                    if not admitted:
+                        return self.overloaded()
+                    return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def metrics(self):
+        return {name: gate.metrics() for name, gate in self.gates.items()}
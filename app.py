@@ -1,24 +1,59 @@
+import os
+
 from flask import Flask, request, jsonify
 from serializers import CourierSerializer,\
-    OrderSerializer, OrderHandler
+    OrderSerializer, OrderHandler, AssignmentFeed, EligibilityIndex
+from archiver import Archiver
+from admission import AdmissionController
+from idempotency import IdempotencyStore
+import bulk
 
 
 app = Flask(__name__)
+archiver = Archiver(interval=60, batch_size=500)
+admission = AdmissionController(retry_after=1)
+# The gates together may hold at most 7 threads (concurrency plus queue),
+# so with the 8 threads of a uWSGI worker ungated reads always get one.
+# Every write takes the SQLite write lock, so the writes share one gate
+admission.add_gate("writes", concurrency=1, queue_size=3)
+admission.add_gate("feed", concurrency=2, queue_size=0)
+admission.add_gate("reports", concurrency=1, queue_size=0)
+idempotency = IdempotencyStore(os.path.join("db", "idempotency.db"))
+
+# Assigning reads only the eligibility index, so it has to be built
+# for an older database before any request is served
+EligibilityIndex.migrate()
 
 
 @app.route("/couriers", methods=["POST"])
+@idempotency.idempotent
 def import_couriers():
-    content = request.get_json()
-    if content.get("data") is None:
-        return jsonify({"validation_error": "no data key"}), 400
-    serializer = CourierSerializer(content["data"], many=True)
-    if serializer.is_valid():
-        serializer.save()
-        return jsonify(serializer.import_response()), 201
+    parallel = False
+    if request.mimetype == bulk.NDJSON_MIMETYPE:
+        try:
+            data = bulk.parse_ndjson(request.get_data())
+        except ValueError:
+            return jsonify({"validation_error": "invalid ndjson"}), 400
+        parallel = True
+    else:
+        content = request.get_json()
+        if content.get("data") is None:
+            return jsonify({"validation_error": "no data key"}), 400
+        data = content["data"]
+    serializer = CourierSerializer(data, many=True)
+    # Only the duplicate check and the insert need the write gate
+    serializer.validate(parallel)
+    with admission.admit("writes") as admitted:
+        if not admitted:
+            return admission.overloaded()
+        if serializer.is_unique():
+            serializer.save()
+            return jsonify(serializer.import_response()), 201
     return jsonify(serializer.import_response()), 400
 
 
 @app.route("/couriers/<int:courier_id>", methods=["PATCH"])
+@admission.limit("writes")
 def patch_courier(courier_id):
     content = request.get_json()
     courier_serializer = CourierSerializer(content)
@@ -40,9 +75,7 @@ def patch_courier(courier_id):
     invalid_orders = []
     for order in order_serializer.valid:
         order.hours_to_periods()
-        if order.weight > courier.lift_capacity or \
-                order.region not in courier.regions or \
-                not order.assignable(courier):
+        if not courier.can_take(order):
             invalid_orders.append(order)
 
     if invalid_orders:
@@ -53,44 +86,50 @@ def patch_courier(courier_id):
 
 
 @app.route("/orders", methods=["POST"])
+@idempotency.idempotent
 def import_orders():
-    content = request.get_json()
-    if content.get("data") is None:
-        return jsonify({"validation_error": "no data key"}), 400
-    serializer = OrderSerializer(content["data"], many=True)
-    if serializer.is_valid():
-        serializer.save()
-        return jsonify(serializer.import_response()), 201
+    parallel = False
+    if request.mimetype == bulk.NDJSON_MIMETYPE:
+        try:
+            data = bulk.parse_ndjson(request.get_data())
+        except ValueError:
+            return jsonify({"validation_error": "invalid ndjson"}), 400
+        parallel = True
+    else:
+        content = request.get_json()
+        if content.get("data") is None:
+            return jsonify({"validation_error": "no data key"}), 400
+        data = content["data"]
+    serializer = OrderSerializer(data, many=True)
+    # Only the duplicate check and the insert need the write gate
+    serializer.validate(parallel)
+    with admission.admit("writes") as admitted:
+        if not admitted:
+            return admission.overloaded()
+        if serializer.is_unique():
+            serializer.save()
+            return jsonify(serializer.import_response()), 201
     return jsonify(serializer.import_response()), 400
 
 
 @app.route("/orders/assign", methods=["POST"])
+@idempotency.idempotent
+@admission.limit("writes")
 def assign_orders():
     content = request.get_json()
-    order_serializer = OrderSerializer(content, many=True)
-    order_serializer.get_free_orders()
     courier = CourierSerializer.get_courier(content["courier_id"])
     if courier is None:
         response = {"error": "No courier with such id"}
         return jsonify(response), 400
 
-    courier.hours_to_periods()
-
-    orders_to_assign = []
-    for order in order_serializer.valid:
-        order.hours_to_periods()
-        if order.weight <= courier.lift_capacity:
-            if order.region in courier.regions:
-                if order.assignable(courier):
-                    orders_to_assign.append(order)
-
-    assigner = OrderHandler(courier, orders_to_assign=orders_to_assign)
-    assigner.assign_orders()
+    assigner = OrderHandler(courier)
+    assigner.assign_candidate_orders()
     response = assigner.response()
     return jsonify(response), 200
 
 
 @app.route("/orders/complete", methods=["POST"])
+@admission.limit("writes")
 def complete_order():
     content = request.get_json()
     courier_id = content.get("courier_id")
@@ -117,16 +156,83 @@ def complete_order():
     return jsonify({"error": "Order not assigned to the given courier"}), 400
 
 
+@app.route("/orders/<int:order_id>/couriers", methods=["GET"])
+def get_order_couriers(order_id):
+    order = OrderSerializer.get_order(order_id)
+    if not order:
+        return jsonify({"error": "Order not found"}), 404
+    courier_ids = EligibilityIndex.get_couriers(order_id)
+    response = {
+        "order_id": order.id,
+        "couriers": [{"id": courier_id} for courier_id in courier_ids]
+    }
+    return jsonify(response), 200
+
+
+@app.route("/orders/events", methods=["GET"])
+@admission.limit("feed")
+def get_assignment_events():
+    cursor = request.args.get("cursor", 0, type=int)
+    limit = request.args.get("limit", 100, type=int)
+    timeout = request.args.get("timeout", 0, type=int)
+    response = AssignmentFeed.poll(cursor, limit, timeout)
+    return jsonify(response), 200
+
+
+@app.route("/couriers/stats", methods=["GET"])
+@admission.limit("reports")
+def get_couriers_stats():
+    couriers = CourierSerializer.get_all_couriers()
+    courier_ids = request.args.get("courier_ids") or None
+    if courier_ids is not None:
+        try:
+            courier_ids = {int(i) for i in courier_ids.split(",")}
+        except ValueError:
+            return jsonify({"error": "Invalid courier_ids"}), 400
+        couriers = [c for c in couriers if c.id in courier_ids]
+    sort = request.args.get("sort")
+    if sort not in (None, "rating", "earnings"):
+        return jsonify({"error": "Invalid sort"}), 400
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            return jsonify({"error": "Invalid limit"}), 400
+    CourierSerializer.get_couriers_stats(couriers, courier_ids)
+    response = CourierSerializer.couriers_stats_response(couriers, sort, limit)
+    return jsonify(response), 200
+
+
 @app.route("/couriers/<int:courier_id>", methods=["GET"])
 def get_courier_info(courier_id):
     courier_serializer = CourierSerializer
+    etag = courier_serializer.get_etag(courier_id)
+    if etag is not None and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
     courier = courier_serializer.get_courier(courier_id)
     if not courier:
         return jsonify({"error": "Courier not found"}), 404
     courier_serializer.get_courier_info(courier)
-    response = courier_serializer.courier_info_response(courier)
-    return jsonify(response), 200
+    response = jsonify(courier_serializer.courier_info_response(courier))
+    if etag is not None:
+        response.set_etag(etag)
+    return response, 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return jsonify({"admission": admission.metrics()}), 200
+
+
+def start_background_tasks():
+    archiver.start()
 
 
 if __name__ == "__main__":
+    start_background_tasks()
     app.run(host="0.0.0.0", port="8000")
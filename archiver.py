@@ -0,0 +1,35 @@
+import sqlite3
+import threading
+import db
+
+
+class Archiver(threading.Thread):
+    """
+    A background thread which periodically moves completed orders
+    out of the hot tables into the archive ones
+    """
+
+    def __init__(self, interval=60, batch_size=500):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.archive()
+            except sqlite3.OperationalError:
+                # The database is locked by a long write, retry next time
+                continue
+
+    def archive(self):
+        archived = 0
+        while True:
+            moved = db.archive_completed_orders(self.batch_size)
+            archived += moved
+            if moved < self.batch_size:
+                return archived
+
+    def stop(self):
+        self.stopped.set()
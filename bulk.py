@@ -0,0 +1,102 @@
+import json
+import multiprocessing
+import os
+import sys
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def parse_ndjson(raw: bytes):
+    """
+    Parses newline delimited JSON, one object per line.
+    Empty lines are skipped.
+    Raises:
+        ValueError if a line is not a JSON object
+    """
+    records = []
+    for line_number, line in enumerate(raw.splitlines(), start=1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict):
+            raise ValueError(f"line {line_number} is not an object")
+        records.append(record)
+    return records
+
+
+def worth_splitting(records, chunk_size):
+    """
+    The pool only adds pickling on top of the validation itself,
+    so it pays off for more than one chunk and more than one CPU
+    """
+    return len(records) > chunk_size and (os.cpu_count() or 1) > 1
+
+
+def get_executor():
+    """
+    Returns the process pool which validates bulk imports.
+    The workers are spawned rather than forked, since the uWSGI worker
+    already runs threads and holds an open SQLite connection.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            context = multiprocessing.get_context("spawn")
+            if "uwsgi" in os.path.basename(sys.executable):
+                # Under uWSGI sys.executable is the uwsgi binary itself
+                context.set_executable(
+                    os.path.join(sys.exec_prefix, "bin", "python3")
+                )
+            _executor = ProcessPoolExecutor(mp_context=context)
+        return _executor
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def map_chunks(serializer_class, chunks):
+    """
+    Validates the chunks in the process pool.
+    A broken pool is replaced by a new one and the chunks are retried once.
+    Returns:
+        A list of the results of validate_chunk in the order of the chunks
+    """
+    for attempt in range(2):
+        executor = get_executor()
+        try:
+            return list(executor.map(
+                validate_chunk, [serializer_class] * len(chunks), chunks
+            ))
+        except BrokenProcessPool:
+            _reset_executor(executor)
+            if attempt:
+                raise
+
+
+def validate_chunk(serializer_class, records):
+    """
+    Validates the records one by one.
+    Returns:
+        A list of (index, id) tuples of the invalid records of the chunk
+    """
+    serializer = serializer_class()
+    failed = []
+    for index, record in enumerate(records):
+        serializer.data = record
+        serializer.to_internal_value()
+        if serializer.invalid:
+            failed.append((index, serializer.invalid.pop()))
+        serializer.valid.clear()
+    return failed
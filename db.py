@@ -1,30 +1,52 @@
 import sqlite3
+import multiprocessing
 import os
+import threading
+
+from contextlib import contextmanager
 
 db_path = os.path.join("db", "database.db")
 conn = sqlite3.connect(db_path, check_same_thread=False)
 cursor = conn.cursor()
+# The write connection and its cursor are shared by the threads
+# of the worker, so only one of them may use it at a time.
+# Reads go through a connection of their own thread, so they don't
+# wait for the writes.
+lock = threading.RLock()
+_transaction_depth = 0
+_transaction_owner = None
+_readers = threading.local()
+
+
+def _read_cursor():
+    """
+    Returns the cursor reads have to use: the shared one inside
+    a transaction of the current thread, so the reads see its changes,
+    a cursor of the thread's own connection otherwise.
+    """
+    if _transaction_owner == threading.get_ident():
+        return cursor
+    if not hasattr(_readers, "cursor"):
+        _readers.cursor = sqlite3.connect(db_path).cursor()
+    return _readers.cursor
 
 
 def _init_db():
     """Initializes the database"""
     with open(os.path.join("db", "create_db.sql"), "r", encoding="utf-8") as f:
         sql = f.read()
-    cursor.executescript(sql)
-    conn.commit()
+    with lock:
+        cursor.executescript(sql)
+        conn.commit()
 
 
 def check_db_exists():
     """
     Checks if db exists.
-    If it does, connects to it.
-    If it doesn't, connects to it and initialize it.
+    If it doesn't, initializes it.
+    If it does, applies the schema again: every statement in it is
+    idempotent, so the tables added to the schema later on get created.
     """
-    cursor.execute("SELECT name FROM sqlite_master "
-                   "WHERE type='table' AND name='couriers'")
-    table_exists = cursor.fetchall()
-    if table_exists:
-        return
     _init_db()
 
 
@@ -32,6 +54,34 @@ def get_cursor():
     return cursor
 
 
+@contextmanager
+def transaction():
+    """
+    Runs the statements of the block in a single transaction,
+    which is rolled back if any of them fails.
+    Nested blocks are a part of the outermost transaction.
+    The write connection lock is held until the transaction ends.
+    """
+    global _transaction_depth, _transaction_owner
+    with lock:
+        if _transaction_depth == 0:
+            cursor.execute("BEGIN IMMEDIATE")
+            _transaction_owner = threading.get_ident()
+        _transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            _transaction_depth -= 1
+            if _transaction_depth == 0:
+                _transaction_owner = None
+                conn.rollback()
+            raise
+        _transaction_depth -= 1
+        if _transaction_depth == 0:
+            _transaction_owner = None
+            conn.commit()
+
+
 def insert_one(table: str, column_values):
     """
     Inserts given values in the given table.
@@ -44,12 +94,12 @@ def insert_one(table: str, column_values):
     columns = ", ".join(column_values.keys())
     values = [tuple(column_values.values())]
     placeholders = ", ".join("?" * len(column_values.keys()))
-    cursor.executemany(
-        f"INSERT INTO {table} "
-        f"({columns}) "
-        f"VALUES ({placeholders})",
-        values)
-    conn.commit()
+    with transaction():
+        cursor.executemany(
+            f"INSERT INTO {table} "
+            f"({columns}) "
+            f"VALUES ({placeholders})",
+            values)
 
 
 def insert_many(table: str, column_values):
@@ -65,12 +115,12 @@ def insert_many(table: str, column_values):
     columns = ", ".join(column_values[0])
     values = [value for value in column_values[1:]]
     placeholders = ", ".join("?" * len(column_values[0]))
-    cursor.executemany(
-        f"INSERT INTO {table} "
-        f"({columns}) "
-        f"VALUES ({placeholders})",
-        values)
-    conn.commit()
+    with transaction():
+        cursor.executemany(
+            f"INSERT INTO {table} "
+            f"({columns}) "
+            f"VALUES ({placeholders})",
+            values)
 
 
 def update(table: str, row_id: int, column_values):
@@ -84,12 +134,12 @@ def update(table: str, row_id: int, column_values):
     columns = [key + " = ?" for key in column_values.keys()]
     columns_w_placeholders = ",\n".join(columns)
     values = [tuple(column_values.values())]
-    cursor.executemany(
-        f"UPDATE {table} "
-        f"SET {columns_w_placeholders}"
-        f"WHERE id = {row_id}",
-        values)
-    conn.commit()
+    with transaction():
+        cursor.executemany(
+            f"UPDATE {table} "
+            f"SET {columns_w_placeholders}"
+            f"WHERE id = {row_id}",
+            values)
 
 
 def get_all(table: str, columns):
@@ -101,6 +151,7 @@ def get_all(table: str, columns):
     Returns:
         A list of column:value dictionaries
     """
+    cursor = _read_cursor()
     columns_joined = ", ".join(columns)
     cursor.execute(f"SELECT {columns_joined} FROM {table}")
     rows = cursor.fetchall()
@@ -122,6 +173,7 @@ def get_id(table: str, row_id: int):
     Returns:
         A tuple of row values
     """
+    cursor = _read_cursor()
     cursor.execute(f"SELECT * FROM {table} WHERE id={row_id}")
     row = cursor.fetchone()
     return row
@@ -133,6 +185,7 @@ def get_ids(table: str):
     Returns:
         A list of ids
     """
+    cursor = _read_cursor()
     cursor.execute(f"SELECT id FROM {table}")
     rows = cursor.fetchall()
     result = []
@@ -141,16 +194,44 @@ def get_ids(table: str):
     return result
 
 
-def get_free_orders():
+def get_existing_ids(table: str, ids: list):
+    """
+    Fetches which of the given ids exist in the given table.
+    The ids are looked up by the primary key, so the cost doesn't
+    depend on the size of the table.
+    Returns:
+        A list of ids
+    """
+    cursor = _read_cursor()
+    result = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"SELECT id FROM {table} "
+                       f"WHERE id IN ({placeholders})",
+                       chunk)
+        for row in cursor.fetchall():
+            result.append(row[0])
+    return result
+
+
+def get_free_orders(order_ids=None):
     """
     Fetches every row from the table 'orders' which was not assigned.
+    Params:
+        order_ids: list - if given, only the orders with these ids are fetched
     Returns:
         A list of column:value dictionaries
     """
+    cursor = _read_cursor()
     columns = ["id", "weight", "region", "delivery_hours", "assigned", "completed"]
     columns_joined = ", ".join(columns)
-    cursor.execute(f"SELECT {columns_joined} FROM orders "
-                   f"WHERE assigned = 0")
+    sql = f"SELECT {columns_joined} FROM orders " \
+          f"WHERE assigned = 0"
+    if order_ids is not None:
+        order_ids_joined = '(' + ",".join(str(int(i)) for i in order_ids) + ')'
+        sql += f" AND id in {order_ids_joined}"
+    cursor.execute(sql)
     rows = cursor.fetchall()
     result = []
     for row in rows:
@@ -165,9 +246,12 @@ def get_assigned_orders(courier_id, complete=False, incomplete=False):
     """
     Fetches every row from the table 'orders' which is associated
     with the given courier in the table 'orders_assigned'.
+    Archived orders are included as well unless only the incomplete
+    ones are requested, since those are never archived.
     Returns:
         A list of column:value dictionaries
     """
+    cursor = _read_cursor()
     columns = ["id", "weight", "region", "delivery_hours", "assigned", "completed"]
     completed_flag = 0
     if complete or incomplete:
@@ -176,11 +260,46 @@ def get_assigned_orders(courier_id, complete=False, incomplete=False):
         if complete:
             completed_flag = 1
     columns_joined = ", ".join(columns)
-    sql = f"SELECT {columns_joined} FROM orders o " \
-          f"JOIN orders_assigned oa ON o.id = oa.order_id " \
+    if incomplete:
+        orders_table, assigned_table = "orders", "orders_assigned"
+    else:
+        orders_table, assigned_table = "orders_all", "orders_assigned_all"
+    sql = f"SELECT {columns_joined} FROM {orders_table} o " \
+          f"JOIN {assigned_table} oa ON o.id = oa.order_id " \
           f"WHERE oa.courier_id = {courier_id}"
     if complete or incomplete:
         sql += f" AND o.completed = {completed_flag}"
+    sql += " ORDER BY o.id"
+    cursor.execute(sql)
+    rows = cursor.fetchall()
+    result = []
+    for row in rows:
+        dict_row = {}
+        for index, column in enumerate(columns):
+            dict_row[column] = row[index]
+        result.append(dict_row)
+    return result
+
+
+def get_completed_orders(courier_ids=None):
+    """
+    Fetches every completed order together with the courier
+    it was assigned to, including the archived ones.
+    Params:
+        courier_ids: list - if given, only the orders of these couriers
+        are fetched
+    Returns:
+        A list of column:value dictionaries
+    """
+    cursor = _read_cursor()
+    columns = ["id", "courier_id", "region", "assign_time", "complete_time"]
+    columns_joined = ", ".join(columns)
+    sql = f"SELECT {columns_joined} FROM orders_all o " \
+          f"JOIN orders_assigned_all oa ON o.id = oa.order_id " \
+          f"WHERE o.completed = 1"
+    if courier_ids is not None:
+        courier_ids_joined = '(' + ",".join(str(int(i)) for i in courier_ids) + ')'
+        sql += f" AND oa.courier_id in {courier_ids_joined}"
     cursor.execute(sql)
     rows = cursor.fetchall()
     result = []
@@ -202,43 +321,294 @@ def assign_orders(courier_id: int, orders: list, timestamp):
     """
     if not orders:
         return
-    insert_values = []
-    order_ids = []
-    for order in orders:
-        insert_values.append("({}, {}, \'{}\')".format(
-            order.id, courier_id, timestamp
-        ))
-        order_ids.append(str(order.id))
-    order_ids_joined = '(' + ",".join(order_ids) + ')'
-    insert_sql = "INSERT INTO orders_assigned " \
-                 "(order_id, courier_id, assign_time) " \
-                 "VALUES " + ", ".join(insert_values)
-    update_sql = "UPDATE orders SET assigned = 1 " \
-                 "WHERE [id] in {}".format(order_ids_joined)
-    cursor.executescript(insert_sql + "; " + update_sql + ';')
-
-
-def dismiss_orders(orders: list):
+    order_ids = [(order.id,) for order in orders]
+    assigned_values = [(order.id, courier_id, timestamp) for order in orders]
+    with transaction():
+        cursor.executemany(
+            "INSERT INTO orders_assigned "
+            "(order_id, courier_id, assign_time) "
+            "VALUES (?, ?, ?)",
+            assigned_values)
+        cursor.executemany(
+            "UPDATE orders SET assigned = 1 "
+            "WHERE id = ?",
+            order_ids)
+        cursor.executemany(
+            "INSERT INTO assignment_events "
+            "(event, order_id, courier_id, event_time) "
+            "VALUES ('assign', ?, ?, ?)",
+            assigned_values)
+        cursor.executemany(
+            "DELETE FROM order_candidates "
+            "WHERE order_id = ?",
+            order_ids)
+        cursor.execute(_bump_versions_sql("?"), (courier_id,))
+
+
+def dismiss_orders(orders: list, timestamp):
     """
     Dismisses given list of orders from the orders_assigned table
     Params:
         orders: list - a list of orders to dismiss
+        timestamp: string - formatted string of the timestamp
     """
     if not orders:
         return
-    order_ids = [str(order.id) for order in orders]
-    order_ids_joined = '(' + ",".join(order_ids) + ')'
-    delete_sql = "DELETE FROM orders_assigned " \
-                 "WHERE [order_id] in {}".format(order_ids_joined)
-    update_sql = "UPDATE orders SET assigned = 0 " \
-                 "WHERE [id] in {}".format(order_ids_joined)
-    cursor.executescript(delete_sql + "; " + update_sql + ';')
+    order_ids = [(order.id,) for order in orders]
+    with transaction():
+        cursor.executemany(
+            "INSERT INTO assignment_events "
+            "(event, order_id, courier_id, event_time) "
+            "SELECT 'dismiss', order_id, courier_id, ? "
+            "FROM orders_assigned "
+            "WHERE order_id = ?",
+            [(timestamp, order.id) for order in orders])
+        cursor.executemany(
+            _bump_versions_sql("SELECT courier_id FROM orders_assigned "
+                               "WHERE order_id = ?"),
+            order_ids)
+        cursor.executemany(
+            "DELETE FROM orders_assigned "
+            "WHERE order_id = ?",
+            order_ids)
+        cursor.executemany(
+            "UPDATE orders SET assigned = 0 "
+            "WHERE id = ?",
+            order_ids)
+
+
+def complete_order(order_id: int, complete_time, timestamp):
+    """
+    Marks the given order as completed
+    Params:
+        order_id: int - id of the order
+        complete_time: string - formatted string of the complete time
+        timestamp: string - formatted string of the server timestamp
+    """
+    with transaction():
+        cursor.execute(
+            "UPDATE orders SET completed = 1, complete_time = ? "
+            "WHERE id = ?",
+            (complete_time, order_id))
+        cursor.execute(
+            "INSERT INTO assignment_events "
+            "(event, order_id, courier_id, event_time) "
+            "SELECT 'complete', order_id, courier_id, ? "
+            "FROM orders_assigned "
+            "WHERE order_id = ?",
+            (timestamp, order_id))
+        cursor.execute(
+            _bump_versions_sql("SELECT courier_id FROM orders_assigned "
+                               "WHERE order_id = ?"),
+            (order_id,))
+
+
+def _bump_versions_sql(courier_ids):
+    """
+    Makes the statement which increments the versions of the couriers.
+    Params:
+        courier_ids: str - a placeholder or a subquery
+    """
+    return "UPDATE courier_versions SET version = version + 1 " \
+           "WHERE courier_id in ({})".format(courier_ids)
+
+
+def bump_courier_versions(courier_ids: list):
+    """
+    Increments the versions of the given couriers, the couriers
+    which don't have one yet get the first version.
+    Params:
+        courier_ids: list - a list of ids of the couriers
+    """
+    if not courier_ids:
+        return
+    with transaction():
+        cursor.executemany(
+            "INSERT INTO courier_versions (courier_id) VALUES (?) "
+            "ON CONFLICT (courier_id) DO UPDATE SET version = version + 1",
+            [(courier_id,) for courier_id in courier_ids])
+
+
+def get_courier_version(courier_id: int):
+    """
+    Fetches the version of the given courier.
+    Returns:
+        The version or None if the courier doesn't exist
+    """
+    cursor = _read_cursor()
+    cursor.execute("SELECT version FROM courier_versions "
+                   "WHERE courier_id = ?",
+                   (courier_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def add_candidates(pairs: list):
+    """
+    Records that the orders can be assigned to the couriers.
+    Params:
+        pairs: list - a list of (order_id, courier_id) tuples
+    """
+    if not pairs:
+        return
+    with transaction():
+        cursor.executemany(
+            "INSERT OR IGNORE INTO order_candidates "
+            "(order_id, courier_id) "
+            "VALUES (?, ?)",
+            pairs)
+
+
+def delete_candidates(column=None, ids=None):
+    """
+    Deletes every row of the table 'order_candidates'
+    the given column of which is one of the given ids,
+    or every row if no column is given.
+    Params:
+        column: str - either 'order_id' or 'courier_id'
+        ids: list - a list of ids
+    """
+    sql = "DELETE FROM order_candidates"
+    if column is not None:
+        if not ids:
+            return
+        ids_joined = '(' + ",".join(str(int(i)) for i in ids) + ')'
+        sql += f" WHERE {column} in {ids_joined}"
+    with transaction():
+        cursor.execute(sql)
+
+
+def get_candidate_orders(courier_id: int):
+    """
+    Fetches every free order which can be assigned to the given courier
+    according to the table 'order_candidates'.
+    Returns:
+        A list of column:value dictionaries
+    """
+    cursor = _read_cursor()
+    columns = ["id", "weight", "region", "delivery_hours", "assigned", "completed"]
+    columns_joined = ", ".join(columns)
+    cursor.execute(f"SELECT {columns_joined} FROM orders o "
+                   f"JOIN order_candidates oc ON o.id = oc.order_id "
+                   f"WHERE oc.courier_id = ? AND o.assigned = 0 "
+                   f"ORDER BY o.id",
+                   (courier_id,))
+    rows = cursor.fetchall()
+    result = []
+    for row in rows:
+        dict_row = {}
+        for index, column in enumerate(columns):
+            dict_row[column] = row[index]
+        result.append(dict_row)
+    return result
+
+
+def get_order_candidates(order_id: int):
+    """
+    Fetches the ids of every courier the given order can be assigned to.
+    Returns:
+        A list of ids
+    """
+    cursor = _read_cursor()
+    cursor.execute("SELECT courier_id FROM order_candidates "
+                   "WHERE order_id = ? ORDER BY courier_id",
+                   (order_id,))
+    rows = cursor.fetchall()
+    result = []
+    for row in rows:
+        result.append(row[0])
+    return result
+
+
+def get_schema_version():
+    cursor = _read_cursor()
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+
+def set_schema_version(version: int):
+    with transaction():
+        cursor.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def get_events(after_id: int, limit: int):
+    """
+    Fetches the assignment events which were logged after the given one.
+    Params:
+        after_id: int - id of the last event seen by the consumer
+        limit: int - the maximum number of events to fetch
+    Returns:
+        A list of column:value dictionaries ordered by id
+    """
+    cursor = _read_cursor()
+    columns = ["id", "event", "order_id", "courier_id", "event_time"]
+    columns_joined = ", ".join(columns)
+    cursor.execute(f"SELECT {columns_joined} FROM assignment_events "
+                   f"WHERE id > ? ORDER BY id LIMIT ?",
+                   (after_id, limit))
+    rows = cursor.fetchall()
+    result = []
+    for row in rows:
+        dict_row = {}
+        for index, column in enumerate(columns):
+            dict_row[column] = row[index]
+        result.append(dict_row)
+    return result
+
+
+def archive_completed_orders(batch_size: int):
+    """
+    Moves a batch of completed orders from the hot tables 'orders' and
+    'orders_assigned' to 'orders_archive' and 'orders_assigned_archive'.
+    Uses its own connection, so it can be run from a background thread.
+    Params:
+        batch_size: int - the maximum number of orders to move
+    Returns:
+        The number of orders moved
+    """
+    archive_conn = sqlite3.connect(db_path, isolation_level=None)
+    archive_cursor = archive_conn.cursor()
+    try:
+        archive_cursor.execute("BEGIN IMMEDIATE")
+        archive_cursor.execute("SELECT id FROM orders "
+                               "WHERE completed = 1 "
+                               f"LIMIT {int(batch_size)}")
+        order_ids = [str(row[0]) for row in archive_cursor.fetchall()]
+        if order_ids:
+            order_ids_joined = '(' + ",".join(order_ids) + ')'
+            archive_cursor.execute(
+                "INSERT OR IGNORE INTO orders_archive "
+                "SELECT * FROM orders "
+                "WHERE id in {}".format(order_ids_joined))
+            archive_cursor.execute(
+                "INSERT OR IGNORE INTO orders_assigned_archive "
+                "SELECT * FROM orders_assigned "
+                "WHERE order_id in {}".format(order_ids_joined))
+            archive_cursor.execute(
+                "DELETE FROM orders_assigned "
+                "WHERE order_id in {}".format(order_ids_joined))
+            archive_cursor.execute(
+                "DELETE FROM orders "
+                "WHERE id in {}".format(order_ids_joined))
+        archive_cursor.execute("COMMIT")
+        return len(order_ids)
+    except sqlite3.Error:
+        if archive_conn.in_transaction:
+            archive_cursor.execute("ROLLBACK")
+        raise
+    finally:
+        archive_conn.close()
 
 
 def delete(table: str, row_id: int):
     row_id = int(row_id)
-    cursor.execute(f"DELETE FROM {table} WHERE id={row_id}")
-    conn.commit()
+    with transaction():
+        cursor.execute(f"DELETE FROM {table} WHERE id={row_id}")
 
 
-check_db_exists()
+# The processes of the bulk import pool only import this module,
+# so they don't apply the schema
+if multiprocessing.parent_process() is None:
+    check_db_exists()
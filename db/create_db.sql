@@ -1,3 +1,5 @@
+PRAGMA journal_mode = WAL;
+
 CREATE TABLE IF NOT EXISTS couriers(
     id INTEGER PRIMARY KEY,
     type VARCHAR(4) NOT NULL,
@@ -21,4 +23,66 @@ CREATE TABLE IF NOT EXISTS orders_assigned(
     assign_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
     FOREIGN KEY (order_id) REFERENCES orders (id),
     FOREIGN KEY (courier_id) REFERENCES couriers (id)
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS orders_assigned_courier_idx
+    ON orders_assigned (courier_id);
+
+CREATE TABLE IF NOT EXISTS orders_archive(
+    id INTEGER PRIMARY KEY,
+    weight FLOAT NOT NULL,
+    region INTEGER NOT NULL,
+    delivery_hours TEXT NOT NULL,
+    assigned INTEGER DEFAULT 0,
+    completed INTEGER DEFAULT 0,
+    complete_time TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS orders_assigned_archive(
+    order_id INTEGER PRIMARY KEY,
+    courier_id INTEGER NOT NULL,
+    assign_time TIMESTAMP NOT NULL,
+    FOREIGN KEY (order_id) REFERENCES orders_archive (id),
+    FOREIGN KEY (courier_id) REFERENCES couriers (id)
+);
+
+CREATE INDEX IF NOT EXISTS orders_assigned_archive_courier_idx
+    ON orders_assigned_archive (courier_id);
+
+CREATE VIEW IF NOT EXISTS orders_all AS
+    SELECT * FROM orders
+    UNION ALL
+    SELECT * FROM orders_archive;
+
+CREATE VIEW IF NOT EXISTS orders_assigned_all AS
+    SELECT * FROM orders_assigned
+    UNION ALL
+    SELECT * FROM orders_assigned_archive;
+
+CREATE TABLE IF NOT EXISTS assignment_events(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event VARCHAR(8) NOT NULL,
+    order_id INTEGER NOT NULL,
+    courier_id INTEGER NOT NULL,
+    event_time TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS order_candidates(
+    order_id INTEGER NOT NULL,
+    courier_id INTEGER NOT NULL,
+    PRIMARY KEY (order_id, courier_id),
+    FOREIGN KEY (order_id) REFERENCES orders (id),
+    FOREIGN KEY (courier_id) REFERENCES couriers (id)
+);
+
+CREATE INDEX IF NOT EXISTS order_candidates_courier_idx
+    ON order_candidates (courier_id);
+
+CREATE TABLE IF NOT EXISTS courier_versions(
+    courier_id INTEGER PRIMARY KEY,
+    version INTEGER DEFAULT 1 NOT NULL,
+    FOREIGN KEY (courier_id) REFERENCES couriers (id)
+);
+
+INSERT OR IGNORE INTO courier_versions (courier_id)
+    SELECT id FROM couriers;
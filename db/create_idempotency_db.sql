@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS responses(
+    idempotency_key TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    token TEXT NOT NULL,
+    status INTEGER,
+    body TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (idempotency_key, endpoint)
+);
+
+CREATE INDEX IF NOT EXISTS responses_created_at_idx
+    ON responses (created_at);
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from functools import wraps
+from time import time
+from uuid import uuid4
+from flask import current_app, request, jsonify
+
+
+class IdempotencyStore:
+    """
+    A class used to keep the responses of the requests sent with
+    an Idempotency-Key header, so their retries are answered without
+    running the request again.
+    The store is a separate database file, so it doesn't compete
+    for the lock of the main one.
+    """
+
+    def __init__(self, path, ttl=24 * 60 * 60, max_entries=10000,
+                 pending_timeout=60):
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        with open(os.path.join("db", "create_idempotency_db.sql"), "r",
+                  encoding="utf-8") as f:
+            sql = f.read()
+        self.cursor.executescript(sql)
+        self.conn.commit()
+
+    def reserve(self, key, endpoint, fingerprint, token):
+        """
+        Reserves the key for a request which is about to run.
+        The first request wins, a pending reservation has no status yet.
+        The token identifies the reservation, so only its owner can
+        refresh, complete or release it. A reservation which wasn't
+        refreshed for pending_timeout is left by a crashed request
+        and is taken over.
+        Returns:
+            None if the key is reserved for this request,
+            the (fingerprint, status, body) tuple of the stored one otherwise
+        """
+        with self.lock:
+            now = time()
+            self.cursor.execute(
+                "DELETE FROM responses "
+                "WHERE idempotency_key = ? AND endpoint = ? "
+                "AND (created_at <= ? "
+                "OR (status IS NULL AND created_at <= ?))",
+                (key, endpoint, now - self.ttl, now - self.pending_timeout))
+            self.cursor.execute(
+                "INSERT OR IGNORE INTO responses "
+                "(idempotency_key, endpoint, fingerprint, token, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, endpoint, fingerprint, token, now))
+            reserved = self.cursor.rowcount == 1
+            stored = None
+            if not reserved:
+                self.cursor.execute(
+                    "SELECT fingerprint, status, body FROM responses "
+                    "WHERE idempotency_key = ? AND endpoint = ?",
+                    (key, endpoint))
+                stored = self.cursor.fetchone()
+            self.conn.commit()
+            return stored
+
+    def refresh(self, key, endpoint, token):
+        """Keeps the reservation of a request which is still running"""
+        with self.lock:
+            self.cursor.execute(
+                "UPDATE responses SET created_at = ? "
+                "WHERE idempotency_key = ? AND endpoint = ? "
+                "AND token = ? AND status IS NULL",
+                (time(), key, endpoint, token))
+            self.conn.commit()
+
+    def release(self, key, endpoint, token):
+        """Drops the reservation of a request which didn't finish"""
+        with self.lock:
+            self.cursor.execute(
+                "DELETE FROM responses "
+                "WHERE idempotency_key = ? AND endpoint = ? "
+                "AND token = ? AND status IS NULL",
+                (key, endpoint, token))
+            self.conn.commit()
+
+    def put(self, key, endpoint, token, status, body):
+        """
+        Stores the response in the reservation of the request,
+        unless the reservation was taken over by another one
+        """
+        with self.lock:
+            now = time()
+            self.cursor.execute(
+                "UPDATE responses SET status = ?, body = ?, created_at = ? "
+                "WHERE idempotency_key = ? AND endpoint = ? "
+                "AND token = ? AND status IS NULL",
+                (status, body, now, key, endpoint, token))
+            self.cursor.execute(
+                "DELETE FROM responses WHERE created_at <= ?",
+                (now - self.ttl,))
+            self.cursor.execute("SELECT COUNT(*) FROM responses")
+            excess = self.cursor.fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.cursor.execute(
+                    "DELETE FROM responses WHERE rowid IN "
+                    "(SELECT rowid FROM responses "
+                    "ORDER BY created_at LIMIT ?)",
+                    (excess,))
+            self.conn.commit()
+
+    def idempotent(self, view):
+        """
+        Decorates a view, so a request repeated with the same
+        Idempotency-Key gets the response of the first one.
+        A repeat which arrives while the first one is still running
+        gets 409. Server errors are not stored, so they can be retried.
+        """
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get("Idempotency-Key")
+            if not key:
+                return view(*args, **kwargs)
+            endpoint = request.method + " " + request.path
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            token = uuid4().hex
+            stored = self.reserve(key, endpoint, fingerprint, token)
+            if stored is not None:
+                stored_fingerprint, status, body = stored
+                if stored_fingerprint != fingerprint:
+                    response = {"error": "Idempotency-Key was used "
+                                         "for a different request"}
+                    return jsonify(response), 422
+                if status is None:
+                    response = {"error": "A request with this "
+                                         "Idempotency-Key is in progress"}
+                    return jsonify(response), 409, {"Retry-After": "1"}
+                return current_app.response_class(
+                    body, status=status, mimetype="application/json"
+                )
+            heartbeat = Heartbeat(self, key, endpoint, token)
+            heartbeat.start()
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                self.release(key, endpoint, token)
+                raise
+            finally:
+                heartbeat.stop()
+            if response.status_code < 500:
+                self.put(key, endpoint, token, response.status_code,
+                         response.get_data(as_text=True))
+            else:
+                self.release(key, endpoint, token)
+            return response
+        return wrapper
+
+
+class Heartbeat(threading.Thread):
+    """
+    A thread which refreshes the reservation of a running request,
+    so it doesn't expire however long the request runs
+    """
+
+    def __init__(self, store, key, endpoint, token):
+        super().__init__(daemon=True)
+        self.store = store
+        self.key = key
+        self.endpoint = endpoint
+        self.token = token
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.store.pending_timeout / 3):
+            self.store.refresh(self.key, self.endpoint, self.token)
+
+    def stop(self):
+        self.stopped.set()
@@ -1,9 +1,12 @@
 import json
 import db
 import re
+import bulk
+import numpy as np
 
 from abc import ABC, abstractmethod
-from datetime import time, datetime
+from datetime import time, datetime, timedelta
+from time import monotonic, sleep
 
 
 class Courier:
@@ -26,10 +29,24 @@ class Courier:
         else:
             return 50
 
+    @property
+    def earning_coefficient(self):
+        if self.type == "foot":
+            return 2
+        elif self.type == "bike":
+            return 5
+        else:
+            return 9
+
     def hours_to_periods(self):
         working_hours = [TimePeriod(timestr) for timestr in self.working_hours]
         self.working_hours = working_hours
 
+    def can_take(self, order):
+        return order.weight <= self.lift_capacity and \
+            order.region in self.regions and \
+            bool(order.assignable(self))
+
 
 class Order:
     def __init__(self, data):
@@ -81,16 +98,30 @@ class OrderHandler:
         timestamp = self.timestamp.isoformat()[:-4] + "Z"
         db.assign_orders(self.courier.id, self.to_assign, timestamp)
 
+    def assign_candidate_orders(self):
+        """
+        Assigns every free order the courier can take according to
+        the eligibility index. The orders are read in the same transaction,
+        so a concurrent assign can't take them in between.
+        """
+        with db.transaction():
+            order_serializer = OrderSerializer(many=True)
+            order_serializer.get_candidate_orders(self.courier.id)
+            self.to_assign = order_serializer.valid
+            self.assign_orders()
+
     def dismiss_orders(self):
-        db.dismiss_orders(self.to_dismiss)
+        timestamp = self.timestamp.isoformat()[:-4] + "Z"
+        with db.transaction():
+            db.dismiss_orders(self.to_dismiss, timestamp)
+            EligibilityIndex.index_orders(
+                [order.id for order in self.to_dismiss]
+            )
 
     @staticmethod
     def complete_order(order, complete_time):
-        db.update(
-            "orders",
-            order.id,
-            {"completed": 1, "complete_time": complete_time}
-        )
+        timestamp = datetime.now().isoformat()[:-4] + "Z"
+        db.complete_order(order.id, complete_time, timestamp)
 
     def response(self):
         orders_response = [{"id": order.id} for order in self.to_assign]
@@ -107,13 +138,145 @@ class OrderHandler:
         return response
 
 
+class AssignmentFeed:
+    """
+    A class used to read the append-only log of assignments,
+    dismissals and completions
+    """
+    max_limit = 1000
+    max_timeout = 30
+    poll_interval = 0.5
+
+    @classmethod
+    def poll(cls, cursor=0, limit=100, timeout=0):
+        """
+        Waits up to timeout seconds until there are events after the cursor.
+        Returns:
+            A dictionary of the events and the cursor to continue from
+        """
+        limit = max(1, min(limit, cls.max_limit))
+        deadline = monotonic() + max(0, min(timeout, cls.max_timeout))
+        events = db.get_events(cursor, limit)
+        while not events and monotonic() < deadline:
+            sleep(cls.poll_interval)
+            events = db.get_events(cursor, limit)
+        if events:
+            cursor = events[-1]["id"]
+        return {"events": events, "cursor": cursor}
+
+
+class EligibilityIndex:
+    """
+    A class used to maintain the precomputed list of couriers
+    every free order can be assigned to.
+    The index is changed in the transaction of the change it follows,
+    so it can't miss a pair because of a crash or a concurrent import.
+    """
+    version = 1
+
+    @staticmethod
+    def match(couriers, orders):
+        """
+        Finds every (order, courier) pair where the courier can take
+        the order. Orders are grouped by region, so every courier is
+        only checked against the orders of its own regions.
+        Returns:
+            A list of (order_id, courier_id) tuples
+        """
+        region_orders = {}
+        for order in orders:
+            order.hours_to_periods()
+            region_orders.setdefault(order.region, []).append(order)
+        pairs = []
+        for courier in couriers:
+            courier.hours_to_periods()
+            for region in set(courier.regions):
+                for order in region_orders.get(region, []):
+                    if courier.can_take(order):
+                        pairs.append((order.id, courier.id))
+        return pairs
+
+    @staticmethod
+    def index_orders(order_ids):
+        """Finds the couriers which can take the given free orders"""
+        with db.transaction():
+            order_serializer = OrderSerializer(many=True)
+            order_serializer.get_free_orders(order_ids)
+            if not order_serializer.valid:
+                return
+            couriers = CourierSerializer.get_all_couriers()
+            pairs = EligibilityIndex.match(couriers, order_serializer.valid)
+            db.add_candidates(pairs)
+
+    @staticmethod
+    def index_couriers(courier_ids=None):
+        """
+        Finds the free orders which the given couriers can take,
+        every courier if no ids are given
+        """
+        with db.transaction():
+            couriers = CourierSerializer.get_all_couriers()
+            if courier_ids is None:
+                db.delete_candidates()
+            else:
+                db.delete_candidates("courier_id", courier_ids)
+                courier_ids = set(courier_ids)
+                couriers = [c for c in couriers if c.id in courier_ids]
+            if not couriers:
+                return
+            order_serializer = OrderSerializer(many=True)
+            order_serializer.get_free_orders()
+            pairs = EligibilityIndex.match(couriers, order_serializer.valid)
+            db.add_candidates(pairs)
+
+    @staticmethod
+    def migrate():
+        """
+        Builds the index of a database which was created before it,
+        the schema version tells whether it was built already.
+        """
+        with db.transaction():
+            if db.get_schema_version() >= EligibilityIndex.version:
+                return
+            EligibilityIndex.index_couriers()
+            db.set_schema_version(EligibilityIndex.version)
+
+    @staticmethod
+    def get_couriers(order_id):
+        return db.get_order_candidates(order_id)
+
+
 class AbstractSerializer(ABC):
+    model = None
+
     def __init__(self, data=None, many=False):
         self.data = data
         self.many = many
         self.valid = []
         self.invalid = []
 
+    def to_internal_value_parallel(self, chunk_size=1000):
+        """
+        Validates the data in chunks in the bulk import process pool.
+        The workers send back only the invalid records, the valid ones
+        are built here, so the objects aren't pickled between processes.
+        The results are merged in the order of the data, so they are
+        the same as the ones of to_internal_value.
+        """
+        if not bulk.worth_splitting(self.data, chunk_size):
+            self.to_internal_value()
+            return
+        starts = range(0, len(self.data), chunk_size)
+        chunks = [self.data[start:start + chunk_size] for start in starts]
+        results = bulk.map_chunks(type(self), chunks)
+        for chunk, failed in zip(chunks, results):
+            failed = dict(failed)
+            for index, element in enumerate(chunk):
+                if index in failed:
+                    self.invalid.append(failed[index])
+                else:
+                    self.valid.append(self.model(element))
+
     def no_duplicates(self, existing_elements):
         i = 0
         while i < len(self.valid):
@@ -136,9 +299,18 @@ class AbstractSerializer(ABC):
                 return None
         return working_hours
 
+    def is_valid(self, parallel=False):
+        self.validate(parallel)
+        return self.is_unique()
+
+    def validate(self, parallel=False):
+        if parallel:
+            self.to_internal_value_parallel()
+        else:
+            self.to_internal_value()
+
     @abstractmethod
-    def is_valid(self):
-        self.to_internal_value()
+    def is_unique(self):
         pass
 
     @abstractmethod
@@ -158,6 +330,7 @@ class CourierSerializer(AbstractSerializer):
     """
     A class used to serialize data received in JSON-format
     """
+    model = Courier
 
     def make_courier(self, data=None):
         courier_id = data.get("courier_id")
@@ -207,8 +380,7 @@ class CourierSerializer(AbstractSerializer):
             couriers_dict["couriers"].append({"id": courier.id})
         return couriers_dict
 
-    def is_valid(self):
-        self.to_internal_value()
+    def is_unique(self):
         existing_couriers = db.get_ids("couriers")
         return self.no_duplicates(existing_couriers)
 
@@ -235,7 +407,10 @@ class CourierSerializer(AbstractSerializer):
             if not self.data[key]:
                 self.invalid.append(courier_id)
                 return
-        db.update("couriers", courier_id, self.data)
+        with db.transaction():
+            db.update("couriers", courier_id, self.data)
+            db.bump_courier_versions([courier_id])
+            EligibilityIndex.index_couriers([courier_id])
 
     def patch_response(self, courier_id):
         if self.invalid:
@@ -258,7 +433,11 @@ class CourierSerializer(AbstractSerializer):
                 json.dumps(courier.regions),
                 json.dumps(courier.working_hours),
             ))
-        db.insert_many("couriers", to_save)
+        courier_ids = [courier.id for courier in self.valid]
+        with db.transaction():
+            db.insert_many("couriers", to_save)
+            db.bump_courier_versions(courier_ids)
+            EligibilityIndex.index_couriers(courier_ids)
 
     @staticmethod
     def get_courier(courier_id):
@@ -273,6 +452,29 @@ class CourierSerializer(AbstractSerializer):
         }
         return Courier(data)
 
+    @staticmethod
+    def get_etag(courier_id):
+        version = db.get_courier_version(courier_id)
+        if version is None:
+            return None
+        return f"{courier_id}-{version}"
+
+    @staticmethod
+    def get_all_couriers():
+        courier_rows = db.get_all(
+            "couriers", ["id", "type", "regions", "working_hours"]
+        )
+        couriers = []
+        for courier_row in courier_rows:
+            data = {
+                "courier_id": courier_row["id"],
+                "courier_type": courier_row["type"],
+                "regions": json.loads(courier_row["regions"]),
+                "working_hours": json.loads(courier_row["working_hours"])
+            }
+            couriers.append(Courier(data))
+        return couriers
+
     @staticmethod
     def get_courier_info(courier):
         order_serializer = OrderSerializer(many=True)
@@ -312,18 +514,104 @@ class CourierSerializer(AbstractSerializer):
         min_time = min(average_delivery_times)
         courier.rating = (60 * 60 - min(min_time, 60*60)) / (60*60) * 5
 
-        if courier.type == "foot":
-            coefficient = 2
-        elif courier.type == "bike":
-            coefficient = 5
-        else:
-            coefficient = 9
-
         whole_deliveries = set()
         for order in order_serializer.valid:
             whole_deliveries.add(order.assign_time)
 
-        courier.earning = len(whole_deliveries) * (500 * coefficient)
+        courier.earning = len(whole_deliveries) * \
+            (500 * courier.earning_coefficient)
+
+    @staticmethod
+    def get_couriers_stats(couriers, courier_ids=None):
+        """
+        Computes rating and earnings of every given courier at once,
+        the same way get_courier_info does it for a single one.
+        The completed orders are only fetched for courier_ids if given,
+        for the whole fleet otherwise.
+        """
+        if not couriers:
+            return
+        completed = db.get_completed_orders(courier_ids)
+        if not completed:
+            return
+
+        def to_microseconds(timestamp):
+            moment = datetime.fromisoformat(timestamp[:-1] + "0000")
+            return (moment - datetime.min) // timedelta(microseconds=1)
+
+        order_ids = np.array([row["id"] for row in completed], dtype=np.int64)
+        courier_ids = np.array(
+            [row["courier_id"] for row in completed], dtype=np.int64
+        )
+        regions = np.array([row["region"] for row in completed], dtype=np.int64)
+        assign_times = np.array(
+            [to_microseconds(row["assign_time"]) for row in completed],
+            dtype=np.int64
+        )
+        complete_times = np.array(
+            [to_microseconds(row["complete_time"]) for row in completed],
+            dtype=np.int64
+        )
+
+        order = np.lexsort((order_ids, complete_times, regions, courier_ids))
+        courier_ids = courier_ids[order]
+        regions = regions[order]
+        assign_times = assign_times[order]
+        complete_times = complete_times[order]
+
+        # Every (courier, region) group starts with its earliest delivery,
+        # which is counted from the assign time, the rest are counted
+        # from the previous delivery in the same region
+        region_start = np.ones(len(order), dtype=bool)
+        region_start[1:] = (courier_ids[1:] != courier_ids[:-1]) | \
+            (regions[1:] != regions[:-1])
+        previous_times = np.empty_like(complete_times)
+        previous_times[0] = assign_times[0]
+        previous_times[1:] = complete_times[:-1]
+        previous_times[region_start] = assign_times[region_start]
+        delivery_times = (complete_times - previous_times) / 1e6
+
+        region_starts = np.flatnonzero(region_start)
+        region_sizes = np.diff(np.append(region_starts, len(order)))
+        averages = np.add.reduceat(delivery_times, region_starts) / region_sizes
+
+        region_couriers = courier_ids[region_starts]
+        courier_start = np.ones(len(region_starts), dtype=bool)
+        courier_start[1:] = region_couriers[1:] != region_couriers[:-1]
+        courier_starts = np.flatnonzero(courier_start)
+        min_times = np.minimum.reduceat(averages, courier_starts)
+        ratings = (60 * 60 - np.minimum(min_times, 60 * 60)) / (60 * 60) * 5
+
+        deliveries = np.unique(np.stack((courier_ids, assign_times)), axis=1)
+        delivery_couriers, whole_deliveries = np.unique(
+            deliveries[0], return_counts=True
+        )
+
+        rating_by_id = dict(zip(region_couriers[courier_starts].tolist(),
+                                ratings.tolist()))
+        deliveries_by_id = dict(zip(delivery_couriers.tolist(),
+                                    whole_deliveries.tolist()))
+        for courier in couriers:
+            courier.rating = rating_by_id.get(courier.id, 0.0)
+            courier.earning = deliveries_by_id.get(courier.id, 0) * \
+                (500 * courier.earning_coefficient)
+
+    @staticmethod
+    def couriers_stats_response(couriers, sort=None, limit=None):
+        if sort == "rating":
+            couriers = sorted(couriers, key=lambda c: (-c.rating, c.id))
+        elif sort == "earnings":
+            couriers = sorted(couriers, key=lambda c: (-c.earning, c.id))
+        else:
+            couriers = sorted(couriers, key=lambda c: c.id)
+        if limit is not None:
+            couriers = couriers[:limit]
+        return {
+            "couriers": [
+                CourierSerializer.courier_info_response(courier)
+                for courier in couriers
+            ]
+        }
 
     @staticmethod
     def courier_info_response(courier):
@@ -340,6 +628,8 @@ class CourierSerializer(AbstractSerializer):
 
 
 class OrderSerializer(AbstractSerializer):
+    model = Order
+
     def __init__(self, data=None, many=False):
         super().__init__(data, many)
 
@@ -372,9 +662,10 @@ class OrderSerializer(AbstractSerializer):
         else:
             self.make_order(self.data)
 
-    def is_valid(self):
-        self.to_internal_value()
-        existing_orders = db.get_ids("orders")
+    def is_unique(self):
+        order_ids = [order.id for order in self.valid]
+        existing_orders = db.get_existing_ids("orders", order_ids) + \
+            db.get_existing_ids("orders_archive", order_ids)
         return self.no_duplicates(existing_orders)
 
     def import_response(self):
@@ -404,7 +695,7 @@ class OrderSerializer(AbstractSerializer):
 
     @staticmethod
     def get_order(order_id):
-        order_row = db.get_id("orders", order_id)
+        order_row = db.get_id("orders_all", order_id)
         if order_row:
             data = {
                 "id": order_row[0],
@@ -417,8 +708,14 @@ class OrderSerializer(AbstractSerializer):
             return Order(data)
         return None
 
-    def get_free_orders(self):
-        self.data = db.get_free_orders()
+    def get_free_orders(self, order_ids=None):
+        self.data = db.get_free_orders(order_ids)
+        for order in self.data:
+            order["delivery_hours"] = json.loads(order["delivery_hours"])
+        self.to_internal_value()
+
+    def get_candidate_orders(self, courier_id):
+        self.data = db.get_candidate_orders(courier_id)
         for order in self.data:
             order["delivery_hours"] = json.loads(order["delivery_hours"])
         self.to_internal_value()
@@ -450,4 +747,6 @@ class OrderSerializer(AbstractSerializer):
                 order.region,
                 json.dumps(order.delivery_hours),
             ))
-        db.insert_many("orders", to_save)
+        with db.transaction():
+            db.insert_many("orders", to_save)
+            EligibilityIndex.index_orders([order.id for order in self.valid])
@@ -1,4 +1,14 @@
-from app import app
+from app import app, start_background_tasks
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    # Threads don't survive uWSGI forking the workers,
+    # so every worker starts its own ones
+    postfork(start_background_tasks)
 
 if __name__ == "__main__":
+    start_background_tasks()
     app.run()